@@ -1,102 +1,124 @@
 from github import Github
 from github.PullRequest import PullRequest
+from github.Commit import Commit
 from github import File
-from typing import List, Dict
+from unidiff import PatchSet
+from typing import List, Dict, Iterator, Tuple
 import base64
+import functools
+import hashlib
 import os
-from step_analysis import StepDefinitionAnalyzer
+import shutil
+import tempfile
+from step_analysis import StepDefinitionAnalyzer, ContextCollector
 from dotenv import load_dotenv
-import json
+
+# Filename suffixes identifying step definition files
+_STEP_SUFFIXES = ("Steps.java", "StepDefinitions.java", "StepsImpl.java", "StepDefs.java")
 
 class GithubStepAnalyzer:
-    def __init__(self, github_token: str, repo_name: str, model: str = "gpt-4o-mini"):
+    def __init__(
+        self, github_token: str, repo_name: str, model: str = "gpt-4o-mini", max_context_tokens: int = 32000,
+        stream: bool = False
+    ):
         self.github = Github(github_token)
         self.repo = self.github.get_repo(repo_name)
-        self.analyzer = StepDefinitionAnalyzer(model=model)
+        # Stream the analysis of a single distinct change and comment on each issue as soon as it completes
+        self.stream = stream
+        self.analyzer = StepDefinitionAnalyzer(model=model, max_context_tokens=max_context_tokens)
         
     def analyze_pull_request(self, pr_number: int) -> Dict:
         """
         Analyze only the changed step definitions in a pull request and post results as comments
         """
         pr = self.repo.get_pull(pr_number)
-        results = []
         
-        # Get modified files
-        files = pr.get_files()
-        commit = pr.get_commits()
-        for file in files:
-            if self._is_step_definition(file.filename):
-                # Get the patch/diff content
-                patch = file.patch
-                if not patch:
-                    continue
-                    
-                # Extract only the added/modified lines
-                changed_content = self._extract_changed_content(patch)
-                if not changed_content:
-                    continue
-                
-                # Analyze only the changed step definitions
-                analysis = self.analyzer.analyze_step(
-                    target_step=str(changed_content),
-                    project_root=self._get_project_files(pr)
-                )
-                # analysis = "test"
-                results.append({
-                    "file": file.filename,
-                    "analysis": analysis,
-                    "changes": changed_content
-                })
-                
-                # Post comment with analysis
-                self._post_analysis_comment(pr, file, analysis, changed_content)
+        # Get modified step definition files that carry a patch/diff
+        step_files = [file for file in pr.get_files() if self._is_step_definition(file.filename) and file.patch]
+        
+        candidates = []
+        for file in step_files:
+            # Extract only the added/modified lines
+            changed_content = list(self._extract_changed_content(file.patch))
+            if changed_content:
+                candidates.append((file, changed_content))
+        
+        if not candidates:
+            return []
+        
+        # Identical changes (e.g. after a copy or rename) are analyzed only once
+        seen = {}
+        cache_keys = []
+        for _, changed_content in candidates:
+            target_step = str(changed_content)
+            cache_key = hashlib.blake2b(target_step.encode(), digest_size=16).hexdigest()
+            # Rank the context on the added code alone, not on the keys of the line dicts
+            ranking_text = "\n".join(line['content'] for line in changed_content)
+            seen.setdefault(cache_key, (target_step, ranking_text))
+            cache_keys.append(cache_key)
+        
+        project_root = self._get_project_files(pr)
+        
+        # Get the head commit of the PR once, the same commit the context was downloaded at
+        commit = self.repo.get_commit(pr.head.sha)
+        
+        # Streaming only pays off for a single request, batches already overlap latency
+        streamed = self.stream and len(seen) == 1
+        if streamed:
+            (cache_key, (target_step, ranking_text)), = seen.items()
+            files = [file for file, _ in candidates]
+            analyses = {
+                cache_key: self._stream_analysis(pr, commit, files, target_step, ranking_text, project_root)
+            }
+        else:
+            # Analyze only the changed step definitions, sharing the project context in one batch
+            analyses = dict(zip(seen, self.analyzer.analyze_steps(
+                target_steps=[target_step for target_step, _ in seen.values()],
+                ranking_texts=[ranking_text for _, ranking_text in seen.values()],
+                project_root=project_root
+            )))
+        
+        results = []
+        for (file, changed_content), cache_key in zip(candidates, cache_keys):
+            analysis = analyses[cache_key]
+            results.append({
+                "file": file.filename,
+                "analysis": analysis,
+                "changes": changed_content
+            })
+            
+            # Post comment with analysis, streamed analyses were commented on as they arrived
+            if not streamed:
+                self._post_analysis_comment(pr, commit, file, analysis, changed_content)
         
         return results
     
-    def _extract_changed_content(self, patch: str) -> List[Dict[str, any]]:
+    def _extract_changed_content(self, patch: str) -> Iterator[Dict[str, any]]:
         """
         Extract added or modified lines from the patch along with their line numbers
         
-        Returns:
-            List of dictionaries containing line content and number
-            [{'content': 'line content', 'line_number': int}, ...]
+        Yields:
+            Dictionaries containing line content and number
+            {'content': 'line content', 'line_number': int}
         """
         if not patch:
-            return []
-            
-        changed_lines = []
-        current_line = 0
-        
-        for line in patch.split('\n'):
-            if line.startswith('@@'):
-                # Parse the line number from the @@ -l,s +l,s @@ line
-                # Format is usually "@@ -l,s +l,s @@" where l is the starting line and s is the size
-                try:
-                    line_info = line.split('+')[1].split(',')[0]
-                    current_line = int(line_info) - 1  # -1 because we increment before using
-                except (IndexError, ValueError):
-                    continue
-            else:
-                current_line += 1
-                # Only include added or modified lines (starting with '+')
-                # Exclude the diff metadata lines (starting with '+++')
-                if line.startswith('+') and not line.startswith('+++'):
-                    changed_lines.append({
-                        'content': line[1:],  # Remove the '+' prefix
-                        'line_number': current_line
-                    })
-        
-        return changed_lines
+            return
+        
+        # GitHub only provides the hunks, so add the file header unidiff expects
+        patch_set = PatchSet(f"--- a/file\n+++ b/file\n{patch}\n")
+        for hunk in patch_set[0]:
+            for line in hunk:
+                # Only include added or modified lines
+                if line.is_added:
+                    yield {
+                        'content': line.value.rstrip('\n'),
+                        'line_number': line.target_line_no
+                    }
 
     
     def _is_step_definition(self, filename: str) -> bool:
         """Check if file is a step definition file"""
-        return (
-            filename.endswith("Steps.java") or
-            filename.endswith("StepDefinitions.java") or
-            filename.endswith("StepsImpl.java") or
-            filename.endswith("StepDefs.java")
-        )
+        return filename.endswith(_STEP_SUFFIXES)
         
     def _get_file_content(self, raw_url: str) -> str:
         """Get content of a file from GitHub"""
@@ -105,56 +127,111 @@ class GithubStepAnalyzer:
     
     def _get_project_files(self, pr: PullRequest) -> str:
         """
-        Create a temporary directory with project files for context
+        Create a temporary directory with the project files needed for context
+        """
+        return self._get_project_files_cached(pr.head.sha)
+    
+    @functools.lru_cache(maxsize=4)
+    def _get_project_files_cached(self, sha: str) -> str:
+        """
+        Download the feature and step definition files read as context at the given commit once
         """
-        import tempfile
-        import os
-        
         temp_dir = tempfile.mkdtemp()
         
-        # Get repository files
-        contents = self.repo.get_contents("")
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                contents.extend(self.repo.get_contents(file_content.path))
-            else:
-                try:
-                    # Create directory structure
-                    file_path = os.path.join(temp_dir, file_content.path)
-                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    
-                    # Download file
-                    with open(file_path, 'wb') as f:
-                        f.write(base64.b64decode(file_content.content))
-                except Exception as e:
-                    print(f"Error downloading {file_content.path}: {e}")
+        # Only the files ContextCollector puts into the prompt, the changed step files are among them
+        relevant_files = [
+            (path, blob_sha) for path, blob_sha in self._list_files(sha)
+            if ContextCollector.is_context_file(path)
+        ]
+        
+        try:
+            # The shared client is not thread-safe and throttles its requests, so download in order.
+            # Blobs are fetched by the SHA from the tree listing instead of resolving each path again.
+            for path, blob_sha in relevant_files:
+                # Create directory structure
+                file_path = os.path.join(temp_dir, path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                
+                # Download file
+                blob = self.repo.get_git_blob(blob_sha)
+                with open(file_path, 'wb') as f:
+                    f.write(base64.b64decode(blob.content))
+        except Exception:
+            # Never cache or analyze against an incomplete context
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
         
         return temp_dir
     
-    def _post_analysis_comment(self, pr: PullRequest, file: File, analysis: Dict, changed_content: str) -> None:
+    def _list_files(self, tree_sha: str, prefix: str = "") -> List[Tuple[str, str]]:
+        """
+        List the (path, blob SHA) of every file below a tree, splitting into subtrees when the listing is truncated
+        """
+        # The recursive tree lists every file of the commit in a single request, up to GitHub's limit
+        tree = self.repo.get_git_tree(tree_sha, recursive=True)
+        if not tree.truncated:
+            return [(prefix + element.path, element.sha) for element in tree.tree if element.type == "blob"]
+        
+        # A truncated listing silently drops entries, so list each subdirectory separately
+        files = []
+        for element in self.repo.get_git_tree(tree_sha).tree:
+            if element.type == "blob":
+                files.append((prefix + element.path, element.sha))
+            elif element.type == "tree":
+                files.extend(self._list_files(element.sha, f"{prefix}{element.path}/"))
+        return files
+    
+    def _stream_analysis(
+        self, pr: PullRequest, commit: Commit, files: List[File], target_step: str, ranking_text: str, project_root: str
+    ) -> Dict:
+        """
+        Stream the analysis of one change, commenting on every file as soon as each issue is complete
+        """
+        posted = 0
+        analysis = {}
+        for analysis in self.analyzer.stream_step(target_step, project_root, ranking_text=ranking_text):
+            # An entry is complete once the next one has started in every list
+            complete = min(len(analysis.get(key) or []) for key in ('issues', 'suggestions', 'line_number')) - 1
+            for idx in range(posted, complete):
+                for file in files:
+                    self._post_issue_comment(
+                        pr, commit, file, analysis['issues'][idx], analysis['suggestions'][idx], analysis['line_number'][idx]
+                    )
+            posted = max(posted, complete)
+        
+        # The last item is the validated analysis, its final entries are complete too
+        remaining = list(zip(analysis['issues'], analysis['suggestions'], analysis['line_number']))[posted:]
+        for issue, suggestion, line_number in remaining:
+            for file in files:
+                self._post_issue_comment(pr, commit, file, issue, suggestion, line_number)
+        
+        return analysis
+    
+    def _post_analysis_comment(self, pr: PullRequest, commit: Commit, file: File, analysis: Dict, changed_content: str) -> None:
         """Post analysis results as a PR comment"""
-        analysis = json.loads(analysis)
-        for idx, _ in enumerate(analysis["issues"]):
-            # Format comment
-            comment = f"""
+        for issue, suggestion, line_number in zip(analysis['issues'], analysis['suggestions'], analysis['line_number']):
+            self._post_issue_comment(pr, commit, file, issue, suggestion, line_number)
+    
+    def _post_issue_comment(
+        self, pr: PullRequest, commit: Commit, file: File, issue: str, suggestion: str, line_number: int
+    ) -> None:
+        """Post a single issue as a review comment on the given line"""
+        # Format comment
+        comment = f"""
 ### Issues Found:
-{analysis['issues'][idx]}
+{issue}
 
 ### Suggestions:
-{analysis['suggestions'][idx]}
+{suggestion}
 """
 
-            # Get the latest commit in the PR
-            commit = list(pr.get_commits())[-1]
-            
-            # Create comment on the specific file
-            pr.create_review_comment(
-                body=comment,
-                commit=commit,
-                path=file.filename,
-                line=analysis['line_number'][idx]
-            )
+        # Create comment on the specific file
+        pr.create_review_comment(
+            body=comment,
+            commit=commit,
+            path=file.filename,
+            line=line_number
+        )
         
     @staticmethod
     def _format_list(items: List[str]) -> str:
@@ -169,8 +246,10 @@ if __name__ == "__main__":
     github_token = os.getenv("GITHUB_TOKEN")
     repo_name = os.getenv("GITHUB_REPOSITORY")
     pr_number = int(os.getenv("PR_NUMBER"))
+    max_context_tokens = int(os.getenv("MAX_CONTEXT_TOKENS", "32000"))
+    stream = os.getenv("STREAM_ANALYSIS", "").lower() in ("1", "true", "yes")
     
     # Initialize and run analyzer
-    analyzer = GithubStepAnalyzer(github_token, repo_name)
+    analyzer = GithubStepAnalyzer(github_token, repo_name, max_context_tokens=max_context_tokens, stream=stream)
     results = analyzer.analyze_pull_request(pr_number)
     print(results)
\ No newline at end of file
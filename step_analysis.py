@@ -1,17 +1,32 @@
 import json
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 import os
-import glob
+import functools
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import tiktoken
 
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
+from langchain_core.runnables import Runnable
 
 from pydantic import BaseModel, Field
 from langfuse.callback import CallbackHandler
 from examples import example_list
 
+# Maximum number of LLM requests in flight during a batch analysis
+MAX_CONCURRENCY = 8
+# Context files kept per section, ranked by keyword overlap with the analyzed step
+MAX_CONTEXT_FILES = 20
+# Leading lines kept from each context file
+MAX_FILE_LINES = 200
+
+# Words of prose and identifiers, camelCase is split so "statusCode" matches "status code"
+_WORD_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
 class StepAnalysis(BaseModel):
     step_text: str = Field(description="The step definition being analyzed")
     issues: List[str] = Field(description="List of identified issues")
@@ -31,53 +46,120 @@ class StepAnalysis(BaseModel):
     confidence: float = Field(description="Confidence score of the analysis")
 
 
+def _keywords(text: str) -> frozenset:
+    """Lowercased words of at least three letters, used to rank context files"""
+    return frozenset(word.lower() for word in _WORD_RE.findall(text) if len(word) > 2)
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_read(path: str, mtime_ns: int) -> str:
+    """Read a file, memoized on its path and modification time"""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
 class ContextCollector:
     def __init__(self, project_root: str):
         self.project_root = project_root
+        self._features = []
+        self._steps = []
+        self._impls = []
+        self._scan()
+
+    def _scan(self) -> None:
+        """Walk the project once and classify files by kind"""
+        for root, dirs, files in os.walk(self.project_root):
+            # Skip hidden directories, like glob does
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                path = os.path.join(root, name)
+                kind = self._classify(os.path.relpath(path, self.project_root).replace(os.sep, "/"))
+                if kind == "feature":
+                    self._features.append(path)
+                elif kind == "step":
+                    self._steps.append(path)
+                    self._impls.append(path)
+                elif kind == "impl":
+                    self._impls.append(path)
+
+    @staticmethod
+    def _classify(path: str) -> Optional[str]:
+        """Classify a project-relative, "/"-separated path as "feature", "step", "impl" or None"""
+        parts = path.split("/")
+        # Skip hidden entries, like glob does
+        if any(part.startswith(".") for part in parts):
+            return None
+        if path.endswith(".feature"):
+            return "feature"
+        if path.endswith(".java"):
+            # Adjust the classification based on your project's structure
+            if len(parts) > 1 and parts[-2] == "steps":
+                return "step"
+            return "impl"
+        return None
+
+    @staticmethod
+    def is_context_file(path: str) -> bool:
+        """Check if a project-relative path is a feature or step definition file used as prompt context"""
+        return ContextCollector._classify(path) in ("feature", "step")
+
+    def fingerprint(self) -> str:
+        """Hash of the paths and modification times of the feature and step definition files"""
+        digest = hashlib.blake2b(digest_size=16)
+        for path in self._features + self._steps:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime_ns = 0
+            digest.update(f"{path}\0{mtime_ns}\n".encode())
+        return digest.hexdigest()
 
     def collect_features(self) -> List[str]:
         """Collect all feature file contents for context"""
-        feature_files = glob.glob(f"{self.project_root}/**/*.feature", recursive=True)
-        return [self._read_file(f) for f in feature_files]
+        return self._read_files(self._features)
 
     def collect_step_definitions(self) -> List[str]:
         """Collect all step definition file contents"""
-        # Adjust patterns based on your project's structure and file extensions
-        patterns = [
-            "**/steps/*.java",
-        ]
-        step_files = []
-        for pattern in patterns:
-            step_files.extend(glob.glob(f"{self.project_root}/{pattern}", recursive=True))
-        return [self._read_file(f) for f in step_files]
+        return self._read_files(self._steps)
 
     def collect_implementation_code(self) -> List[str]:
         """Collect relevant implementation code"""
-        # Adjust patterns based on your project structure
-        impl_patterns = [
-            "**/*.java",
-            # Add patterns for other languages as needed
-        ]
-        impl_files = []
-        for pattern in impl_patterns:
-            impl_files.extend(glob.glob(f"{self.project_root}/{pattern}", recursive=True))
-        return [self._read_file(f) for f in impl_files]
+        return self._read_files(self._impls)
+
+    def _read_files(self, files: List[str]) -> List[str]:
+        """Read files concurrently, reading each distinct path only once"""
+        unique_files = list(dict.fromkeys(files))
+        if not unique_files:
+            return []
+        with ThreadPoolExecutor(max_workers=min(32, len(unique_files))) as executor:
+            return list(executor.map(self._read_file, unique_files))
 
     @staticmethod
     def _read_file(path: str) -> str:
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
+            return _cached_read(path, os.stat(path).st_mtime_ns)
         except Exception as e:
             print(f"Error reading {path}: {e}")
             return ""
 
 
 class StepDefinitionAnalyzer:
-    def __init__(self, model="gpt-4o-mini"):
+    def __init__(self, model="gpt-4o-mini", max_context_tokens=32000):
         self.llm = ChatOpenAI(temperature=0, model=model)
-        self.parser = PydanticOutputParser(pydantic_object=StepAnalysis)
+        # Token budget shared by the feature and step definition context of a prompt
+        self.max_context_tokens = max_context_tokens
+        self.model = model
+        # Loaded on first use, tiktoken downloads its BPE file from the network
+        self._encoding = None
+        self._encoding_loaded = False
         self.analysis_chain = self._create_analysis_chain()
+        # Built on the first stream_step call
+        self._streaming_chain = None
+        # project_root -> (fingerprint, (features, step_defs))
+        self._context_cache = {}
+        self._context_lock = threading.Lock()
+        # hash of target step and context -> analysis result
+        self._result_cache = {}
 
     def _load_and_parse_examples(self, file_name="bogus_example.json") -> str:
 
@@ -92,7 +174,7 @@ class StepDefinitionAnalyzer:
 
         return examples_text
 
-    def _create_analysis_chain(self) -> PromptTemplate:
+    def _create_analysis_chain(self, schema=StepAnalysis) -> Runnable:
         template = """
         You are a code quality expert. Analyze this specific step definition in the context of the entire test suite to detect BOGUS tests.
         Please only report important warning.
@@ -136,41 +218,166 @@ class StepDefinitionAnalyzer:
 
         example bogus code:
         {examples}
-        
-        Return your analysis in the following JSON format:
-        {format_instructions}
         """
 
-        return PromptTemplate(
+        prompt = PromptTemplate(
             input_variables=["target_step", "feature_context", "step_context", "examples"],
             template=template,
-            partial_variables={"format_instructions": self.parser.get_format_instructions()},
-            output_parser=self.parser,
         )
+        # The schema is sent through function calling, so the model returns a parsed StepAnalysis
+        return prompt | self.llm.with_structured_output(schema)
 
     def analyze_step(self, target_step: str, project_root: str, langfuse_handler=None) -> Dict:
         """
         Analyze a specific step definition using the entire codebase as context
         """
+        return self.analyze_steps([target_step], project_root, langfuse_handler=langfuse_handler)[0]
+
+    def analyze_steps(
+        self, target_steps: List[str], project_root: str, langfuse_handler=None, ranking_texts: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """
+        Analyze several step definitions sharing the same codebase context in a single batch
+
+        ranking_texts holds the code each context is ranked against, the target steps themselves by default.
+        """
         config = {"callbacks": [langfuse_handler]} if langfuse_handler else {}
         
-        # Collect context
-        collector = ContextCollector(project_root)
-        features = collector.collect_features()
-        step_defs = collector.collect_step_definitions()
-        examples = self._load_and_parse_examples()
-        inputs = {
+        # Collect context once, then keep the files relevant to each step
+        features, step_defs = self._get_context(project_root)
+        contexts = [
+            self._select_context(ranking_text, features, step_defs)
+            for ranking_text in (ranking_texts or target_steps)
+        ]
+        cache_keys = [
+            self._cache_key(target_step, *context) for target_step, context in zip(target_steps, contexts)
+        ]
+        pending = [idx for idx, cache_key in enumerate(cache_keys) if cache_key not in self._result_cache]
+
+        if pending:
+            examples = self._load_and_parse_examples()
+            inputs = [
+                self._build_inputs(target_steps[idx], *contexts[idx], examples)
+                for idx in pending
+            ]
+            # Run analyses, issuing the LLM requests concurrently
+            results = self.analysis_chain.batch(inputs, config={**config, "max_concurrency": MAX_CONCURRENCY})
+
+            # Cache results
+            for idx, result in zip(pending, results):
+                self._result_cache[cache_keys[idx]] = result.model_dump()
+
+        return [self._result_cache[cache_key] for cache_key in cache_keys]
+
+    def stream_step(
+        self, target_step: str, project_root: str, langfuse_handler=None, ranking_text: Optional[str] = None
+    ) -> Iterator[Dict]:
+        """
+        Stream partial analyses of a specific step definition as the model generates them
+
+        Each yielded dict holds the fields completed so far, stop iterating to cancel the request.
+        The last yielded dict is the complete, validated analysis, which is cached like analyze_steps results.
+        """
+        config = {"callbacks": [langfuse_handler]} if langfuse_handler else {}
+
+        feature_context, step_context = self._select_context(
+            ranking_text or target_step, *self._get_context(project_root)
+        )
+        cache_key = self._cache_key(target_step, feature_context, step_context)
+        if cache_key in self._result_cache:
+            yield self._result_cache[cache_key]
+            return
+
+        if self._streaming_chain is None:
+            # A JSON schema instead of the model class makes the chain yield partial dicts while streaming
+            self._streaming_chain = self._create_analysis_chain(schema=StepAnalysis.model_json_schema())
+
+        inputs = self._build_inputs(target_step, feature_context, step_context, self._load_and_parse_examples())
+        partial = None
+        for partial in self._streaming_chain.stream(inputs, config=config):
+            yield partial
+        if partial is None:
+            raise ValueError("The model returned no analysis")
+
+        analysis = StepAnalysis.model_validate(partial).model_dump()
+        self._result_cache[cache_key] = analysis
+        yield analysis
+
+    @staticmethod
+    def _cache_key(target_step: str, feature_context: str, step_context: str) -> str:
+        return hashlib.blake2b("\0".join((target_step, feature_context, step_context)).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _build_inputs(target_step: str, feature_context: str, step_context: str, examples: str) -> Dict:
+        return {
             "target_step": target_step,
-            "feature_context": "\n\n".join(features),
-            "step_context": "\n\n".join(step_defs),
+            "feature_context": feature_context,
+            "step_context": step_context,
             "examples": examples,
         }
-        # Run analysis
-        chain = self.analysis_chain | self.llm | StrOutputParser()
-        result = chain.invoke(inputs, config=config)
 
-        # Parse and return results
-        return self.parser.parse(result).model_dump_json(indent=2)
+    def _get_context(self, project_root: str) -> Tuple[List[Tuple], List[Tuple]]:
+        """
+        Return the prepared feature and step definition files, rebuilt only when the files change
+        """
+        collector = ContextCollector(project_root)
+        fingerprint = collector.fingerprint()
+        with self._context_lock:
+            cached = self._context_cache.get(project_root)
+            if cached and cached[0] == fingerprint:
+                return cached[1]
+
+            context = (
+                self._prepare_documents(collector.collect_features()),
+                self._prepare_documents(collector.collect_step_definitions()),
+            )
+            self._context_cache[project_root] = (fingerprint, context)
+            return context
+
+    def _prepare_documents(self, contents: List[str]) -> List[Tuple[str, frozenset, int]]:
+        """
+        Truncate each file and precompute its keywords and token count for ranking
+        """
+        documents = []
+        for content in contents:
+            text = "\n".join(content.splitlines()[:MAX_FILE_LINES])
+            documents.append((text, _keywords(text), self._count_tokens(text)))
+        return documents
+
+    def _count_tokens(self, text: str) -> int:
+        """
+        Count tokens with the model's tokenizer, estimating from the length when it cannot be loaded
+        """
+        if not self._encoding_loaded:
+            self._encoding_loaded = True
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"Error loading tokenizer, estimating token counts instead: {e}")
+
+        if self._encoding is None:
+            return len(text) // 4
+        return len(self._encoding.encode_ordinary(text))
+
+    def _select_context(self, ranking_text: str, features: List[Tuple], step_defs: List[Tuple]) -> Tuple[str, str]:
+        """
+        Join the files most relevant to the ranking text, each section within half the token budget
+        """
+        keywords = _keywords(ranking_text)
+        sections = []
+        for documents in (features, step_defs):
+            ranked = sorted(documents, key=lambda document: len(keywords & document[1]), reverse=True)
+            budget = self.max_context_tokens // 2
+            selected = []
+            for text, _, token_count in ranked[:MAX_CONTEXT_FILES]:
+                if token_count <= budget:
+                    selected.append(text)
+                    budget -= token_count
+            sections.append("\n\n".join(selected))
+        return sections[0], sections[1]
 
 
 def test_multiple_cases(langfuse_handler):
@@ -194,7 +401,7 @@ def main():
     analyzer = StepDefinitionAnalyzer()
     result = analyzer.analyze_step(target_step=target_step, project_root="./bogusdetector", langfuse_handler=langfuse_handler)
 
-    print(result)
+    print(json.dumps(result, indent=2))
 
 
 if __name__ == "__main__":